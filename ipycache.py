@@ -3,10 +3,22 @@
 long-lasting computations.
 """
 
+import argparse
+import ast
+import contextlib
 import hashlib
+import json
+import mmap
 import os
+import pickletools
 import re
+import shutil
+import struct
 import sys
+import threading
+import zipfile
+import zlib
+from io import BytesIO
 
 from traitlets.config.configurable import Configurable
 from IPython.core import magic_arguments
@@ -14,7 +26,7 @@ from IPython.core.magic import Magics, magics_class, line_magic, cell_magic
 from IPython.display import clear_output
 import IPython.utils.io
 from IPython.utils.io import CapturedIO, capture_output
-from traitlets import Unicode
+from traitlets import Int, Unicode
 
 
 # ------------------------------------------------------------------------------
@@ -50,6 +62,16 @@ else:
         exec("""exec _code_ in _globs_, _locs_""")
 
 
+if hasattr(os, 'replace'):
+    _replace = os.replace
+else:
+    def _replace(src, dst):
+        """Rename a file, overwriting the destination."""
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
 def iteritems(d, **kw):
     """Return an iterator over the (key, value) pairs of a dictionary."""
     return iter(getattr(d, _iteritems)(**kw))
@@ -70,18 +92,61 @@ except ImportError:
 # ------------------------------------------------------------------------------
 
 
-def conditional_eval(var, variables):
+# Types of the values handled by {code} statements evaluated in safe mode:
+# indexing these containers and formatting these values runs no user code.
+_SAFE_CONTAINERS = (dict, list, tuple)
+_SAFE_VALUES = (str, int, float, bool, type(None))
+
+
+def _safe_eval(code, variables):
+    """Evaluate an expression made of names, constants and subscripts of
+    built-in containers, raising a ValueError for anything else."""
+    def _eval(node):
+        if isinstance(node, ast.Expression):
+            return _eval(node.body)
+        if isinstance(node, ast.Name) and node.id in variables:
+            return variables[node.id]
+        if hasattr(ast, 'Constant') and isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, getattr(ast, 'Num', ())):
+            return node.n
+        if isinstance(node, getattr(ast, 'Str', ())):
+            return node.s
+        if isinstance(node, getattr(ast, 'Index', ())):
+            return _eval(node.value)
+        if isinstance(node, ast.Subscript):
+            value, key = _eval(node.value), _eval(node.slice)
+            if (type(value) in _SAFE_CONTAINERS and
+                    type(key) in _SAFE_VALUES):
+                return value[key]
+        raise ValueError("The expression '{0:s}' cannot be evaluated "
+                         "safely.".format(code))
+    try:
+        value = _eval(ast.parse(code.strip(), mode='eval'))
+    except (SyntaxError, KeyError, IndexError, TypeError):
+        value = None
+    if type(value) not in _SAFE_VALUES or value is None:
+        raise ValueError("The expression '{0:s}' cannot be evaluated "
+                         "safely.".format(code))
+    return value
+
+
+def conditional_eval(var, variables, safe=False):
     """Evaluates the variable string if it starts with $.
 
     If the variable string contains one or several {code} statements, the code
     is executed and the result stringified (wrapped in str()) into the rest of
-    the string.
+    the string. In safe mode, only names, constants and subscripts of built-in
+    containers evaluating to strings or numbers are allowed, and a ValueError
+    is raised for any other expression, so that no user code is executed.
     """
     if var[0] == '$':
         return variables.get(var[1:], var)
 
     def evalfun(x):
         code = x.group(0)[1:-1]
+        if safe:
+            return str(_safe_eval(code, variables))
         return str(eval(code, variables))
     return re.sub(r'{.*?}', evalfun, var, flags=re.DOTALL)
 
@@ -96,6 +161,38 @@ def clean_vars(vars):
     return sorted(map(clean_var, vars))
 
 
+def split_vars(vars, variables={}):
+    """Split variable specifications into variable names and column requests.
+
+    A variable can be followed by a list of columns, as in `df[a,b]`, in which
+    case only these columns are loaded from the cache. A `$name` column item is
+    replaced by the column name(s) stored in the `name` variable.
+
+    Returns:
+
+      * names: the list of variable names.
+      * columns: a dictionary {var_name: [column, ...]}.
+    """
+    names, columns = [], {}
+    for name, cols in re.findall(r'([^\s,\[\]]+)(?:\s*\[([^\]]*)\])?',
+                                 ' '.join(vars)):
+        names.append(name)
+        if not cols:
+            continue
+        columns[name] = []
+        for col in cols.split(','):
+            col = col.strip().strip('\'"')
+            if not col:
+                continue
+            if col[0] == '$':
+                col = variables.get(col[1:], col)
+            if isinstance(col, (list, tuple)):
+                columns[name].extend(col)
+            else:
+                columns[name].append(col)
+    return names, columns
+
+
 def do_save(path, force=False, read=False):
     """Return True or False whether the variables need to be saved or not."""
     if force and read:
@@ -106,57 +203,767 @@ def do_save(path, force=False, read=False):
     return force or (not read and not os.path.exists(path))
 
 
-def load_vars(path, vars):
-    """Load variables from a pickle file.
+# ------------------------------------------------------------------------------
+# Cache file format
+# ------------------------------------------------------------------------------
+# A cache file starts with a magic string, a format version, the number of
+# records and a use counter per entry, followed by one record per variable.
+# Each record is a fixed-size header (length of the metadata, length of the
+# payload, checksum of the metadata), the JSON metadata (variable name,
+# serialization format and checksum of the payload) and the payload. Checksums
+# are verified before deserializing a record, so that the intact variables of a
+# damaged file can be salvaged. A file holds several entries, one per version
+# of the cell and its inputs, and the records of each entry are contiguous. The
+# counter of an entry is increased in place when it is loaded, so that the
+# least recently used entries are dropped first. DataFrames and dicts of arrays
+# are stored in a columnar format so that a subset of their columns can be
+# loaded without deserializing the others. Files without the magic string are
+# plain pickle files written by older versions. Version 1 files have no record
+# count and no checksums, version 2 files hold a single entry and version 3
+# files have no use counters.
+
+_MAGIC = b'IPYCACHE'
+_VERSION = struct.Struct('<H')
+_COUNT = struct.Struct('<I')
+_USES = struct.Struct('<H')
+_USE = struct.Struct('<Q')
+_RECORD_V1 = struct.Struct('<IQ')
+_RECORD = struct.Struct('<IQI')
+_FORMAT_VERSION = 4
+# Placeholder of the payload checksum in the record metadata, replaced once
+# the payload has been written.
+_CRC_PLACEHOLDER = '00000000'
+
+
+class CacheCorruptedError(ValueError):
+    """Raised when some variables of a cache file are damaged.
+
+    The intact variables are available in the `cache` attribute, and the
+    names of the damaged variables in the `damaged` attribute.
+    """
+
+    def __init__(self, message, cache={}, damaged=[]):
+        super(CacheCorruptedError, self).__init__(message)
+        self.cache = cache
+        self.damaged = damaged
+
+
+class _RecordWriter(object):
+    """Write-only file-like object, with positions relative to the start of
+    the record payload."""
+
+    closed = False
+
+    def __init__(self, f):
+        self._f = f
+        self.size = 0
+        self.crc32 = 0
+
+    def write(self, data):
+        # Pickle protocol 5 writes PickleBuffer objects, which have no len().
+        size = memoryview(data).nbytes
+        self._f.write(data)
+        self.size += size
+        self.crc32 = zlib.crc32(data, self.crc32)
+        return size
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self._f.flush()
+
+
+class _RecordReader(object):
+    """Read-only file-like object over a window of a larger buffer."""
+
+    closed = False
+
+    def __init__(self, buf, offset, size):
+        self._buf = buf
+        self._offset = offset
+        self._size = size
+        self._pos = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0 or self._pos + n > self._size:
+            n = self._size - self._pos
+        start = self._offset + self._pos
+        self._pos += n
+        return self._buf[start:start + n]
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._size
+        self._pos = min(max(pos, 0), self._size)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def seekable(self):
+        return True
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        return pyarrow
+    except ImportError:
+        return None
+
+
+def _is_dataframe(value):
+    # pandas is only imported by the user, never by ipycache.
+    pd = sys.modules.get('pandas')
+    return pd is not None and isinstance(value, pd.DataFrame)
+
+
+def _is_array_dict(value):
+    np = sys.modules.get('numpy')
+    return (np is not None and isinstance(value, dict) and value and
+            all(isinstance(k, str) and type(v) is np.ndarray and
+                not v.dtype.hasobject for k, v in iteritems(value)))
+
+
+def _dump_pickle(value, f):
+    dump(value, f)
+
+
+def _select_columns(value, columns):
+    """Select columns from a DataFrame or keys from a dictionary."""
+    if columns is None:
+        return value
+    if _is_dataframe(value):
+        return value[columns]
+    if isinstance(value, dict):
+        return {col: value[col] for col in columns}
+    raise ValueError("Columns can only be selected from DataFrames and "
+                     "dictionaries, not from {0:s}.".format(
+                         type(value).__name__))
+
+
+def _load_pickle(buf, offset, size, columns=None, meta={}):
+    return _select_columns(pickle.loads(buf[offset:offset + size]), columns)
+
+
+def _dump_arrow(value, f):
+    pa = _import_pyarrow()
+    table = pa.Table.from_pandas(value)
+    with pa.ipc.new_file(pa.PythonFile(f, mode='w'), table.schema) as writer:
+        writer.write_table(table)
+
+
+def _describe_arrow(value):
+    pa = _import_pyarrow()
+    schema = pa.Schema.from_pandas(value)
+    index = [col for col in schema.pandas_metadata.get('index_columns', [])
+             if not isinstance(col, dict)]
+    return {'fields': schema.names, 'index': index}
+
+
+def _load_arrow(buf, offset, size, columns=None, meta={}):
+    pa = _import_pyarrow()
+    options = None
+    if columns is not None:
+        # Only read the requested columns and the index, which is stored as
+        # additional columns.
+        fields = meta['fields']
+        missing = sorted(set(columns) - set(fields))
+        if missing:
+            raise KeyError("Columns not found: {0:s}".format(
+                ', '.join(map(str, missing))))
+        names = list(columns) + meta['index']
+        options = pa.ipc.IpcReadOptions(
+            included_fields=sorted(fields.index(name) for name in names))
+    # Read through a file-like object rather than a zero-copy buffer, so that
+    # the DataFrame does not keep references to the mapped file.
+    table = pa.ipc.open_file(
+        pa.PythonFile(_RecordReader(buf, offset, size), mode='r'),
+        options=options).read_all()
+    if columns is not None:
+        table = table.select(names)
+    return table.to_pandas()
+
+
+def _dump_npz(value, f):
+    import numpy as np
+    with zipfile.ZipFile(f, 'w') as zf:
+        for key, arr in iteritems(value):
+            arr_f = BytesIO()
+            np.lib.format.write_array(arr_f, arr, allow_pickle=False)
+            zf.writestr(key + '.npy', arr_f.getvalue())
+
+
+def _load_npz(buf, offset, size, columns=None, meta={}):
+    import numpy as np
+    with np.load(_RecordReader(buf, offset, size), allow_pickle=False) as npz:
+        return {key: npz[key]
+                for key in (npz.files if columns is None else columns)}
+
+
+# Serialization formats: {format: (dump(value, f), load(buf, offset, size,
+# columns, meta), describe(value))}. describe() returns additional metadata
+# stored in the record.
+_SERIALIZERS = {
+    'pickle': (_dump_pickle, _load_pickle, None),
+    'arrow': (_dump_arrow, _load_arrow, _describe_arrow),
+    'npz': (_dump_npz, _load_npz, None),
+}
+
+
+def _is_str_or_none(value):
+    return value is None or isinstance(value, str)
+
+
+def _is_arrow_exact(value, sample_size=16):
+    """Return whether a DataFrame round-trips exactly through Arrow."""
+    pd = sys.modules['pandas']
+    pa = _import_pyarrow()
+    if (pa is None or type(value) is not pd.DataFrame or
+            not value.columns.is_unique or
+            not all(isinstance(col, str) for col in value.columns) or
+            not all(map(_is_str_or_none, value.index.names))):
+        return False
+    # Arrow infers a type for object columns: only strings are kept as is.
+    if not all(value[col].map(_is_str_or_none).all()
+               for col, dtype in iteritems(value.dtypes) if dtype == object):
+        return False
+    # Other changes (dtypes, index) are detected on a sample of the rows.
+    sample = value.iloc[:sample_size]
+    try:
+        pd.testing.assert_frame_equal(
+            pa.Table.from_pandas(sample).to_pandas(), sample)
+    except Exception:
+        return False
+    return True
+
+
+def _serialization_format(value):
+    """Return the most efficient serialization format available for a value."""
+    # Arrow is only used when the DataFrame round-trips exactly, other
+    # DataFrames are pickled.
+    if _is_dataframe(value) and _is_arrow_exact(value):
+        return 'arrow'
+    if _is_array_dict(value):
+        return 'npz'
+    return 'pickle'
+
+
+def _write_record(f, name, value, entry=None, count=0):
+    """Write a variable in a record, falling back to pickle if the columnar
+    serialization fails."""
+    fmt = _serialization_format(value)
+    start = f.tell()
+    while True:
+        try:
+            dump, _, describe = _SERIALIZERS[fmt]
+            meta = {'name': name, 'format': fmt, 'crc32': _CRC_PLACEHOLDER,
+                    'entry': entry, 'count': count}
+            if describe is not None:
+                meta.update(describe(value))
+            meta = json.dumps(meta, sort_keys=True)
+            f.write(_RECORD.pack(len(meta), 0, 0))
+            f.write(meta.encode('utf-8'))
+            payload = _RecordWriter(f)
+            dump(value, payload)
+            break
+        except Exception:
+            if fmt == 'pickle':
+                raise
+            # Some DataFrames (e.g. with mixed-type object columns) cannot be
+            # converted to Arrow.
+            fmt = 'pickle'
+            f.seek(start)
+            f.truncate()
+    end = f.tell()
+    # The checksum has a fixed width, so that the length of the metadata does
+    # not change.
+    meta = meta.replace('"crc32": "{0:s}"'.format(_CRC_PLACEHOLDER),
+                        '"crc32": "{0:08x}"'.format(payload.crc32 & 0xffffffff),
+                        1).encode('utf-8')
+    f.seek(start)
+    f.write(_RECORD.pack(len(meta), payload.size,
+                         zlib.crc32(meta) & 0xffffffff))
+    f.write(meta)
+    f.seek(end)
+
+
+def _scan_records(buf, offset, size):
+    """Scan the records of a cache file stored in buf[offset:offset+size],
+    without deserializing them.
+
+    Returns:
+
+      * version: the format version of the file.
+      * records: a list of (meta, start, payload_start, end, intact) tuples,
+        where start and end are the bounds of the whole record, and intact
+        is whether the payload is within the file. Payload checksums are
+        only verified when a record is loaded, see `_verify_payload()`.
+      * complete: whether all the records of the file were found.
+    """
+    end = offset + size
+    pos = offset + len(_MAGIC)
+    if pos + _VERSION.size > end:
+        return _FORMAT_VERSION, [], False
+    version, = _VERSION.unpack(buf[pos:pos + _VERSION.size])
+    pos += _VERSION.size
+    if version > _FORMAT_VERSION:
+        raise IOError("The cache file format version {0:d} is not supported "
+                      "by this version of ipycache.".format(version))
+    record = _RECORD if version >= 2 else _RECORD_V1
+    count = None
+    if version >= 2:
+        if pos + _COUNT.size > end:
+            return version, [], False
+        count, = _COUNT.unpack(buf[pos:pos + _COUNT.size])
+        pos += _COUNT.size
+    if version >= 4:
+        if pos + _USES.size > end:
+            return version, [], False
+        uses, = _USES.unpack(buf[pos:pos + _USES.size])
+        pos += _USES.size + uses * _USE.size
+    records = []
+    while pos + record.size <= end:
+        start = pos
+        header = record.unpack(buf[pos:pos + record.size])
+        meta_size, payload_size = header[:2]
+        pos += record.size
+        meta = buf[pos:pos + meta_size]
+        if (len(meta) < meta_size or
+                (version >= 2 and zlib.crc32(meta) & 0xffffffff != header[2])):
+            # The lengths cannot be trusted: the next records are lost.
+            break
+        try:
+            meta = json.loads(meta.decode('utf-8'))
+        except ValueError:
+            break
+        pos += meta_size
+        if pos + payload_size > end:
+            records.append((meta, start, pos, end, False))
+            break
+        records.append((meta, start, pos, pos + payload_size, True))
+        pos += payload_size
+    complete = (count is None or len(records) == count) and all(
+        intact for _, _, _, _, intact in records)
+    return version, records, complete
+
+
+def _scan_uses(buf, offset, size, count):
+    """Return the use counters of the count entries of a cache file stored
+    in buf[offset:offset+size].
+
+    Returns a (pos, uses) pair, where pos is the offset of the first counter
+    in buf, or None if the file has no use counters, and uses is a list of
+    count counters. Missing counters are 0.
+    """
+    uses = []
+    pos = offset + len(_MAGIC) + _VERSION.size + _COUNT.size
+    version, = _VERSION.unpack(buf[offset + len(_MAGIC):
+                                   offset + len(_MAGIC) + _VERSION.size])
+    if version < 4 or pos + _USES.size > offset + size:
+        pos = None
+    else:
+        n, = _USES.unpack(buf[pos:pos + _USES.size])
+        pos += _USES.size
+        n = min(n, count, (offset + size - pos) // _USE.size)
+        uses = [_USE.unpack(buf[pos + i * _USE.size:
+                                pos + (i + 1) * _USE.size])[0]
+                for i in range(n)]
+    return pos, uses + [0] * (count - len(uses))
+
+
+def _crc32(buf, start, end, chunk_size=1 << 20):
+    """Return the CRC32 of buf[start:end], computed by chunks."""
+    crc = 0
+    for pos in range(start, end, chunk_size):
+        crc = zlib.crc32(buf[pos:min(pos + chunk_size, end)], crc)
+    return crc & 0xffffffff
+
+
+def _verify_payload(buf, meta, start, end, columns=None):
+    """Return whether the payload of a record matches its checksum.
+
+    NPZ payloads are not verified when some of their columns are selected:
+    the checksums of the zip archive members are verified while reading them
+    instead, so that the other columns are not read. Arrow payloads are
+    always verified entirely, which reads the whole payload even if only a
+    few columns are deserialized.
+    """
+    if 'crc32' not in meta or (meta['format'] == 'npz' and
+                               columns is not None):
+        return True
+    return '{0:08x}'.format(_crc32(buf, start, end)) == meta['crc32']
+
+
+def _entries(records):
+    """Group records by cache entry, in the order of the file.
+
+    Returns a list of (entry, records, complete) tuples.
+    """
+    entries = []
+    for record in records:
+        entry = record[0].get('entry')
+        if not entries or entries[-1][0] != entry:
+            entries.append((entry, []))
+        entries[-1][1].append(record)
+    return [(entry, recs, all(r[4] for r in recs) and
+             len(recs) == recs[0][0].get('count', len(recs)))
+            for entry, recs in entries]
+
+
+def _read_records(buf, offset, size, columns={}, entry=None):
+    """Read the variables of a cache entry stored in buf[offset:offset+size].
+
+    The most recently used entry is read if there is no entry with the
+    specified key.
+
+    Returns:
+
+      * cache: a dictionary {var_name: var_value} of the intact variables.
+      * damaged: the names of the damaged variables, including None if some
+        variables were lost and their names are unknown.
+    """
+    version, records, complete = _scan_records(buf, offset, size)
+    entries = _entries(records)
+    if not entries:
+        return {}, [None]
+    selected = [e for e in entries if e[0] == entry]
+    if not selected:
+        uses = _scan_uses(buf, offset, size, len(entries))[1]
+        selected = [entries[uses.index(max(uses))]]
+    entry, records, entry_complete = selected[0]
+    cache, damaged = {}, []
+    for meta, _, payload_start, end, intact in records:
+        name = meta['name']
+        cols = columns.get(name)
+        if not intact or not _verify_payload(buf, meta, payload_start, end,
+                                             cols):
+            damaged.append(name)
+            continue
+        load = _SERIALIZERS[meta['format']][1]
+        try:
+            cache[name] = load(buf, payload_start, end - payload_start,
+                               cols, meta)
+        except zipfile.BadZipfile:
+            # Checksum of an unverified NPZ payload.
+            damaged.append(name)
+    # Before version 3, all the records belong to the same entry.
+    if not entry_complete or (version < 3 and not complete):
+        damaged.append(None)
+    return cache, damaged
+
+
+@contextlib.contextmanager
+def _open_cache_file(path):
+    """Map a cache file in memory, yielding None for a missing file or a
+    pickle file."""
+    if not os.path.exists(path):
+        yield None
+        return
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            yield None
+            return
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
+
+
+def _read_vars(path, columns={}, entry=None):
+    """Read all the variables of a cache entry, without any check.
+
+    Returns a (cache, damaged) pair, see `_read_records()`.
+    """
+    with _open_cache_file(path) as buf:
+        if buf is not None:
+            return _read_records(buf, 0, len(buf), columns, entry)
+    with open(path, 'rb') as f:
+        return _read_pickle(f, columns)
+
+
+def _read_pickle(f, columns={}):
+    """Read the variables of a pickle file written by older versions."""
+    try:
+        cache = pickle.load(f)
+    except (EOFError, pickle.UnpicklingError):
+        # Truncated pickle files cannot be salvaged.
+        return {}, [None]
+    for name, cols in iteritems(columns):
+        if name in cache:
+            cache[name] = _select_columns(cache[name], cols)
+    return cache, []
+
+
+def entry_key(cell_md5, inputs_md5=None):
+    """Return the key of the cache entry of a cell and its inputs."""
+    if inputs_md5 is None:
+        return cell_md5
+    return hashlib.md5((cell_md5 + inputs_md5).encode()).hexdigest()
+
+
+def _fingerprint(value):
+    """Return a hash of a value which does not depend on the order of sets
+    and dictionaries."""
+    np = sys.modules.get('numpy')
+    pd = sys.modules.get('pandas')
+    md5 = hashlib.md5(type(value).__name__.encode())
+    if np is not None and type(value) is np.ndarray:
+        md5.update(str((value.dtype, value.shape)).encode())
+        md5.update(np.ascontiguousarray(value).tobytes())
+    elif pd is not None and isinstance(value, (pd.DataFrame, pd.Series)):
+        md5.update(pickle.dumps(list(value.axes), 2))
+        md5.update(pd.util.hash_pandas_object(value).values.tobytes())
+    elif isinstance(value, (set, frozenset)):
+        for item in sorted(_fingerprint(item) for item in value):
+            md5.update(item.encode())
+    elif isinstance(value, dict):
+        for item in sorted(_fingerprint(k) + _fingerprint(v)
+                           for k, v in iteritems(value)):
+            md5.update(item.encode())
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            md5.update(_fingerprint(item).encode())
+    else:
+        md5.update(pickle.dumps(value, 2))
+    return md5.hexdigest()
+
+
+def inputs_fingerprint(inputs, user_ns):
+    """Return a hash of the values of a list of input variables."""
+    md5 = hashlib.md5()
+    for var in inputs:
+        try:
+            md5.update(_fingerprint(user_ns[var]).encode())
+        except (pickle.PicklingError, TypeError, AttributeError) as e:
+            raise ValueError(("Input variable '{0:s}' cannot be hashed: "
+                              "{1:s}").format(var, str(e)))
+    return md5.hexdigest()
+
+
+def load_vars(path, vars, columns={}, prefetcher=None, entry=None):
+    """Load variables from a cache file.
 
     Arguments:
 
-      * path: the path to the pickle file.
+      * path: the path to the cache file.
       * vars: a list of variable names.
+      * columns: a dictionary {var_name: [column, ...]} of the columns to load
+        for DataFrames and dictionaries of arrays.
+      * prefetcher: a CachePrefetcher instance which may already have loaded
+        the file in the background.
+      * entry: the key of the cache entry to load. The most recently used
+        entry is loaded if there is no entry with this key.
 
     Returns:
 
       * cache: a dictionary {var_name: var_value}.
+
+    A CacheCorruptedError, holding the intact variables, is raised if some
+    variables are damaged.
     """
-    with open(path, 'rb') as f:
-        # Load the variables from the cache.
+    # Load the variables from the cache.
+    loaded = None
+    if prefetcher is not None:
+        loaded = prefetcher.take(path, columns, entry)
+    if loaded is None:
+        loaded = _read_vars(path, columns, entry)
+    return _check_vars(path, vars, *loaded)
+
+
+def _check_vars(path, vars, cache, damaged):
+    """Check the variables loaded from a cache file, see `load_vars()`."""
+    if damaged:
+        # The names of the lost records are unknown: report the requested
+        # variables which are missing.
+        damaged = sorted(set(name for name in damaged if name is not None) |
+                         (set(vars) - set(cache) if None in damaged
+                          else set()))
+        raise CacheCorruptedError(
+            "The following variables are damaged in the cache file "
+            "'{0:s}': {1:s}".format(path, ', '.join(
+                ["'{0:s}'".format(var) for var in damaged]) or 'unknown'),
+            cache=cache, damaged=damaged)
+
+    # Check that all requested variables could be loaded successfully
+    # from the cache.
+    missing_vars = sorted(set(vars) - set(cache.keys()))
+    if missing_vars:
+        raise ValueError(("The following variables could not be loaded "
+                          "from the cache: {0:s}").format(
+            ', '.join(["'{0:s}'".format(var) for var in missing_vars])))
+    additional_vars = sorted(set(cache.keys()) - set(vars))
+    for hidden_variable in '_captured_io', '_cell_md5', '_inputs_md5':
         try:
-            cache = pickle.load(f)
-        except EOFError as e:
-            cache = {}
-            #raise IOError(str(e))
-
-        # Check that all requested variables could be loaded successfully
-        # from the cache.
-        missing_vars = sorted(set(vars) - set(cache.keys()))
-        if missing_vars:
-            raise ValueError(("The following variables could not be loaded "
-                              "from the cache: {0:s}").format(
-                ', '.join(["'{0:s}'".format(var) for var in missing_vars])))
-        additional_vars = sorted(set(cache.keys()) - set(vars))
-        for hidden_variable in '_captured_io', '_cell_md5':
+            additional_vars.remove(hidden_variable)
+        except ValueError:
+            pass
+    if additional_vars:
+        raise ValueError("The following variables were present in the cache, "
+                         "but removed from the storage request: {0:s}".format(
+                             ', '.join(["'{0:s}'".format(var) for var in additional_vars])))
+
+    return cache
+
+
+def _copy_range(buf, start, end, f, chunk_size=1 << 20):
+    """Copy buf[start:end] into a file by chunks."""
+    for pos in range(start, end, chunk_size):
+        f.write(buf[pos:min(pos + chunk_size, end)])
+
+
+def _copy_records(buf, records, f, entry=None):
+    """Copy raw records from a mapped cache file into another file.
+
+    The metadata of records written before version 3, which do not have an
+    entry key, is rewritten with the specified entry key.
+    """
+    for meta, start, payload_start, end, _ in records:
+        if 'entry' in meta:
+            _copy_range(buf, start, end, f)
+            continue
+        meta = dict(meta, entry=entry, count=len(records))
+        meta = json.dumps(meta, sort_keys=True).encode('utf-8')
+        f.write(_RECORD.pack(len(meta), end - payload_start,
+                             zlib.crc32(meta) & 0xffffffff))
+        f.write(meta)
+        _copy_range(buf, payload_start, end, f)
+
+
+def _legacy_entry_key(buf, records):
+    """Return the entry key of the records of a cache file written before
+    version 3, or None if it cannot be found."""
+    for meta, _, payload_start, end, intact in records:
+        if (meta['name'] == '_cell_md5' and intact and
+                _verify_payload(buf, meta, payload_start, end)):
+            load = _SERIALIZERS[meta['format']][1]
             try:
-                additional_vars.remove(hidden_variable)
-            except ValueError:
-                pass
-        if additional_vars:
-            raise ValueError("The following variables were present in the cache, "
-                             "but removed from the storage request: {0:s}".format(
-                                 ', '.join(["'{0:s}'".format(var) for var in additional_vars])))
+                return entry_key(load(buf, payload_start,
+                                      end - payload_start, None, meta))
+            except (EOFError, pickle.UnpicklingError):
+                return None
+    return None
 
-        return cache
 
+def _stored_entries(buf, offset, size):
+    """Return the complete entries of a cache file stored in
+    buf[offset:offset+size].
 
-def save_vars(path, vars_d):
-    """Save variables into a pickle file.
+    Returns a list of (entry, records, use) tuples, sorted from the most
+    to the least recently used. The single entry of a file written before
+    version 3 is keyed by its `_cell_md5` variable.
+    """
+    version, records, complete = _scan_records(buf, offset, size)
+    if version < 3:
+        entry = _legacy_entry_key(buf, records) if complete else None
+        return [(entry, records, 0)] if entry is not None else []
+    entries = _entries(records)
+    uses = _scan_uses(buf, offset, size, len(entries))[1]
+    # Entries of version 3 files, which have no use counters, are already
+    # sorted from the most to the least recently used.
+    stored = [(entry, recs, use)
+              for (entry, recs, entry_complete), use in zip(entries, uses)
+              if entry_complete]
+    stored.sort(key=lambda e: -e[2])
+    return stored
+
+
+def _write_entries(f, entries):
+    """Write a cache file from a list of (buf, entry, records, use)
+    tuples, where records are copied from the mapped file buf, or are a
+    dictionary {var_name: var_value} if buf is None."""
+    f.write(_MAGIC)
+    f.write(_VERSION.pack(_FORMAT_VERSION))
+    f.write(_COUNT.pack(sum(len(e[2]) for e in entries)))
+    f.write(_USES.pack(len(entries)))
+    for _, _, _, use in entries:
+        f.write(_USE.pack(use))
+    for buf, entry, records, _ in entries:
+        if buf is None:
+            for name in sorted(records):
+                _write_record(f, name, records[name], entry, len(records))
+        else:
+            _copy_records(buf, records, f, entry)
+
+
+def save_vars(path, vars_d, entry=None, max_entries=1):
+    """Save variables into a cache file.
 
     Arguments:
 
-      * path: the path to the pickle file.
+      * path: the path to the cache file.
       * vars_d: a dictionary {var_name: var_value}.
+      * entry: the key of the cache entry, see `entry_key()`.
+      * max_entries: the maximum number of entries kept in the file. The
+        least recently used entries are dropped.
+    """
+    # Write in a temporary file first, so that an interrupted write does not
+    # damage an existing cache file.
+    tmp_path = path + '.tmp'
+    with _open_cache_file(path) as buf, open(tmp_path, 'wb') as f:
+        kept = []
+        if buf is not None and max_entries > 1:
+            # Damaged entries are dropped.
+            kept = [(buf, e, records, use)
+                    for e, records, use in _stored_entries(buf, 0, len(buf))
+                    if e != entry][:max_entries - 1]
+        use = max([e[3] for e in kept] + [0]) + 1
+        _write_entries(f, [(None, entry, vars_d, use)] + kept)
+    _replace(tmp_path, path)
+
+
+def _merge_entries(path, buf, offset, size, max_entries=3):
+    """Add the entries of a cache file stored in buf[offset:offset+size]
+    which an existing cache file does not have, keeping at most max_entries
+    entries. Return whether the file has been modified."""
+    if buf[offset:offset + len(_MAGIC)] != _MAGIC:
+        return False
+    with _open_cache_file(path) as old_buf:
+        if old_buf is None:
+            return False
+        old = _stored_entries(old_buf, 0, len(old_buf))
+        old_entries = set(e for e, _, _ in old)
+        # The added entries are less recently used than the existing ones.
+        added = [(buf, e, records, 0)
+                 for e, records, _ in _stored_entries(buf, offset, size)
+                 if e not in old_entries][:max(max_entries - len(old), 0)]
+        if not added:
+            return False
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            _write_entries(f, [(old_buf, e, records, use)
+                               for e, records, use in old] + added)
+    _replace(tmp_path, path)
+    return True
+
+
+def use_entry(path, entry):
+    """Mark a cache entry as the most recently used one.
+
+    The use counter of the entry is updated in place. Files written before
+    version 4 are left unchanged, as well as files which cannot be written.
     """
-    with open(path, 'wb') as f:
-        dump(vars_d, f)
+    with _open_cache_file(path) as buf:
+        if buf is None:
+            return
+        entries = [e[0] for e in _entries(_scan_records(buf, 0, len(buf))[1])]
+        pos, uses = _scan_uses(buf, 0, len(buf), len(entries))
+        if pos is None or entry not in entries:
+            return
+        i = entries.index(entry)
+        if uses[i] == max(uses) or pos + (i + 1) * _USE.size > len(buf):
+            return
+    try:
+        with open(path, 'r+b') as f:
+            f.seek(pos + i * _USE.size)
+            f.write(_USE.pack(max(uses) + 1))
+    except (IOError, OSError):
+        pass
 
 
 # ------------------------------------------------------------------------------
@@ -242,6 +1049,376 @@ class capture_output_and_print(object):
         if self.display and self.shell:
             self.shell.display_pub = self.save_display_pub
 
+# -----------------------------------------------------------------------------
+# Prefetching
+# ------------------------------------------------------------------------------
+
+
+def notebook_cache_cells(path):
+    """Return the (line, cell) pairs of the %%cache cells of a notebook file."""
+    with open(path) as f:
+        nb = json.load(f)
+    cells = nb.get('cells', [])
+    # Notebook format 3.
+    for ws in nb.get('worksheets', []):
+        cells.extend(ws.get('cells', []))
+    out = []
+    for cell in cells:
+        if cell.get('cell_type') != 'code':
+            continue
+        source = cell.get('source', cell.get('input', ''))
+        if isinstance(source, list):
+            source = ''.join(source)
+        line, _, code = source.lstrip().partition('\n')
+        # IPython passes the body of a cell magic with a trailing newline.
+        if code and not code.endswith('\n'):
+            code += '\n'
+        if line.startswith('%%cache '):
+            out.append((line[len('%%cache '):], code))
+    return out
+
+
+class CachePrefetcher(object):
+    """Load cache files in background threads into a bounded buffer.
+
+    Files are loaded in the order they were requested. The size of the files
+    on disk is used as an estimate of the memory used by the loaded variables:
+    threads wait until enough memory is released by `take()` before loading
+    the next file, and files larger than the buffer are never prefetched. A
+    file waiting for space is loaded right away once `take()` asks for it.
+    """
+
+    def __init__(self, max_size=1 << 30, n_threads=4):
+        self.max_size = max_size
+        self.n_threads = n_threads
+        self._cond = threading.Condition()
+        self._queue = []  # [(path, columns, entry)]
+        self._loading = {}  # {path: 'waiting' or 'reading'}
+        self._wanted = set()  # paths of the files waited for by take()
+        self._loaded = {}  # {path: (stat, (columns, entry), cache)}
+        self._size = 0
+        self._threads = 0
+
+    def prefetch(self, paths):
+        """Prefetch a list of (path, columns, entry) tuples in the background.
+        """
+        with self._cond:
+            for path, columns, entry in paths:
+                path = os.path.abspath(path)
+                if (path not in self._loading and path not in self._loaded
+                        and path not in [p for p, _, _ in self._queue]):
+                    self._queue.append((path, columns, entry))
+            while self._threads < min(self.n_threads, len(self._queue)):
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._threads += 1
+
+    def take(self, path, columns={}, entry=None):
+        """Return and forget the (cache, damaged) pair prefetched from a file,
+        or None if the file has not been prefetched or has been modified
+        since."""
+        path = os.path.abspath(path)
+        with self._cond:
+            # A file which is still queued is faster to load synchronously.
+            self._queue = [item for item in self._queue if item[0] != path]
+            if path in self._loading:
+                self._wanted.add(path)
+                self._cond.notify_all()
+                while path in self._loading:
+                    self._cond.wait()
+                self._wanted.discard(path)
+            if path not in self._loaded:
+                return None
+            stat, request, cache = self._loaded.pop(path)
+            self._size -= stat[1]
+            self._cond.notify_all()
+        if request != (columns, entry) or stat != _stat(path):
+            return None
+        return cache
+
+    def join(self):
+        """Wait until the pending files are loaded, or waiting for space in
+        the buffer."""
+        with self._cond:
+            while True:
+                states = list(self._loading.values())
+                if ('reading' not in states and
+                        (not self._queue or
+                         states.count('waiting') >= self._threads)):
+                    return
+                self._cond.wait()
+
+    def clear(self):
+        """Cancel pending loads and release the buffer."""
+        with self._cond:
+            self._queue = []
+            for path in list(self._loading):
+                if self._loading[path] == 'waiting':
+                    del self._loading[path]
+            for stat, _, _ in self._loaded.values():
+                self._size -= stat[1]
+            self._loaded.clear()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.notify_all()
+                if not self._queue:
+                    self._threads -= 1
+                    return
+                path, columns, entry = self._queue.pop(0)
+                stat = _stat(path)
+                if stat is None or stat[1] > self.max_size:
+                    continue
+                self._loading[path] = 'waiting'
+                self._cond.notify_all()
+                while (self._loading.get(path) == 'waiting' and
+                       path not in self._wanted and
+                       self._size + stat[1] > self.max_size):
+                    self._cond.wait()
+                if path not in self._loading:
+                    # Cancelled by clear().
+                    continue
+                self._loading[path] = 'reading'
+                self._size += stat[1]
+            try:
+                cache = _read_vars(path, columns, entry)
+            except Exception:
+                cache = None
+            with self._cond:
+                del self._loading[path]
+                if cache is None:
+                    self._size -= stat[1]
+                else:
+                    self._loaded[path] = (stat, (columns, entry), cache)
+                self._cond.notify_all()
+
+
+def _stat(path):
+    """Return the modification time and size of a file, or None."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+# -----------------------------------------------------------------------------
+# Bundles
+# ------------------------------------------------------------------------------
+# A bundle packs several cache files in a single file: a magic string and a
+# format version, the cache files, a JSON index {name: {offset, size, mtime}}
+# and a trailer (offset and size of the index, magic string). Names are the
+# paths of the cache files relative to the cache directory. The bundle is
+# mapped in memory, so that a cache file can be read without extracting it.
+
+_BUNDLE_MAGIC = b'IPYCBNDL'
+_BUNDLE_TRAILER = struct.Struct('<QQ')
+_BUNDLE_VERSION = 1
+
+
+def _is_cache_file(path):
+    """Return whether a file is a cache file, or a pickle file written by
+    older versions."""
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) == _MAGIC:
+            return True
+        f.seek(0)
+        try:
+            for _ in pickletools.genops(f):
+                pass
+        except Exception:
+            return False
+        # A cache file holds a single pickle.
+        return not f.read(1)
+
+
+def _check_bundle_name(name):
+    """Raise a ValueError if the name of a cache file of a bundle is not a
+    relative path within the cache directory."""
+    parts = re.split(r'[\\/]', name)
+    if (not name or os.path.isabs(name) or parts[0] == '' or
+            os.path.splitdrive(name)[0] or '..' in parts):
+        raise ValueError("'{0:s}' is not a valid name for a cache file of a "
+                         "bundle.".format(name))
+
+
+def _bundle_files(paths, root, exclude=()):
+    """Return the {name: path} dictionary of the cache files to bundle, where
+    directories are expanded recursively. Files which are not cache files
+    and the files in exclude are skipped."""
+    exclude = [os.path.abspath(path) for path in exclude]
+    files = {}
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.update(_bundle_files(
+                    [os.path.join(dirpath, filename)
+                     for filename in filenames], root, exclude))
+        elif (os.path.isfile(path) and not path.endswith('.tmp') and
+                os.path.abspath(path) not in exclude and
+                _is_cache_file(path)):
+            name = os.path.relpath(os.path.abspath(path),
+                                   os.path.abspath(root))
+            name = name.replace(os.sep, '/')
+            _check_bundle_name(name)
+            files[name] = path
+    return files
+
+
+def export_bundle(bundle_path, paths, root='.'):
+    """Pack cache files into a bundle.
+
+    Arguments:
+
+      * bundle_path: the path to the bundle file.
+      * paths: a list of cache files or directories containing cache files.
+        Other files are skipped.
+      * root: the directory relative to which the cache files are named. A
+        ValueError is raised for cache files outside of this directory.
+
+    Returns:
+
+      * names: the sorted names of the cache files in the bundle.
+    """
+    files = _bundle_files(paths, root, exclude=[bundle_path])
+    index = {}
+    tmp_path = bundle_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_BUNDLE_MAGIC)
+        f.write(_VERSION.pack(_BUNDLE_VERSION))
+        for name in sorted(files):
+            offset = f.tell()
+            with open(files[name], 'rb') as src:
+                shutil.copyfileobj(src, f)
+            index[name] = {'offset': offset, 'size': f.tell() - offset,
+                           'mtime': os.path.getmtime(files[name])}
+        index_data = json.dumps(index, sort_keys=True).encode('utf-8')
+        index_offset = f.tell()
+        f.write(index_data)
+        f.write(_BUNDLE_TRAILER.pack(index_offset, len(index_data)))
+        f.write(_BUNDLE_MAGIC)
+    _replace(tmp_path, bundle_path)
+    return sorted(index)
+
+
+class CacheBundle(object):
+    """Read-only access to the cache files of a bundle.
+
+    Usage:
+
+        with CacheBundle('caches.ipcb') as bundle:
+            vars = bundle.load_vars('mycache.pkl', ['var1', 'var2'])
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.index = self._read_index()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_index(self):
+        buf = self._buf
+        trailer_size = _BUNDLE_TRAILER.size + len(_BUNDLE_MAGIC)
+        if (len(buf) < len(_BUNDLE_MAGIC) + _VERSION.size + trailer_size or
+                buf[:len(_BUNDLE_MAGIC)] != _BUNDLE_MAGIC or
+                buf[-len(_BUNDLE_MAGIC):] != _BUNDLE_MAGIC):
+            raise IOError("'{0:s}' is not a valid cache bundle.".format(
+                self.path))
+        pos = len(_BUNDLE_MAGIC)
+        version, = _VERSION.unpack(buf[pos:pos + _VERSION.size])
+        if version > _BUNDLE_VERSION:
+            raise IOError("The cache bundle format version {0:d} is not "
+                          "supported by this version of ipycache.".format(
+                              version))
+        offset, size = _BUNDLE_TRAILER.unpack(
+            buf[-trailer_size:-len(_BUNDLE_MAGIC)])
+        return json.loads(buf[offset:offset + size].decode('utf-8'))
+
+    def names(self):
+        """Return the sorted names of the cache files of the bundle."""
+        return sorted(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _member(self, name):
+        if name not in self.index:
+            raise KeyError("'{0:s}' is not in the cache bundle '{1:s}'.".format(
+                name, self.path))
+        return self.index[name]['offset'], self.index[name]['size']
+
+    def load_vars(self, name, vars, columns={}, entry=None):
+        """Load variables from a cache file of the bundle, see `load_vars()`.
+        """
+        offset, size = self._member(name)
+        buf = self._buf
+        if buf[offset:offset + len(_MAGIC)] == _MAGIC:
+            loaded = _read_records(buf, offset, size, columns, entry)
+        else:
+            loaded = _read_pickle(BytesIO(buf[offset:offset + size]), columns)
+        return _check_vars(name, vars, *loaded)
+
+    def extract(self, name, path, merge=True, max_entries=3):
+        """Write a cache file of the bundle to a path.
+
+        If the file exists, the entries of the bundled file which it does not
+        have are added to it when merge is True, keeping at most max_entries
+        entries, and nothing is done otherwise. Return whether the file has
+        been written.
+        """
+        offset, size = self._member(name)
+        buf = self._buf
+        if os.path.exists(path):
+            return merge and _merge_entries(path, buf, offset, size,
+                                            max_entries)
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            _copy_range(buf, offset, offset + size, f)
+        _replace(tmp_path, path)
+        return True
+
+    def close(self):
+        self._buf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def import_bundle(bundle_path, root='.', names=None, merge=True,
+                  max_entries=3):
+    """Unpack the cache files of a bundle into a directory.
+
+    Cache files which already exist are not overwritten: when merge is True,
+    only the entries they do not have yet are added to them, up to
+    max_entries entries per file. A ValueError is raised if a name refers to
+    a file outside of the directory.
+
+    Returns:
+
+      * names: the sorted names of the cache files which have been written.
+    """
+    with CacheBundle(bundle_path) as bundle:
+        names = bundle.names() if names is None else names
+        for name in names:
+            _check_bundle_name(name)
+        return [name for name in names
+                if bundle.extract(name, os.path.join(root, *name.split('/')),
+                                  merge=merge, max_entries=max_entries)]
+
+
 # -----------------------------------------------------------------------------
 # %%cache Magics
 # ------------------------------------------------------------------------------
@@ -252,13 +1429,24 @@ def cache(cell, path, vars=[],
           # without IPython, by giving mock functions here instead of IPython
           # methods.
           ip_user_ns={}, ip_run_cell=None, ip_push=None, ip_clear_output=lambda: None,
-          force=False, read=False, verbose=True):
+          force=False, read=False, verbose=True, columns={}, prefetcher=None,
+          inputs=[], max_versions=1):
 
     if not path:
         raise ValueError("The path needs to be specified as a first argument.")
 
     path = os.path.abspath(path)
     cell_md5 = hashlib.md5(cell.encode()).hexdigest()
+    # The cache file holds one entry per version of the cell and its inputs.
+    inputs_md5 = None
+    if inputs:
+        inputs_missing = sorted(set(inputs) - set(ip_user_ns.keys()))
+        if inputs_missing:
+            raise ValueError(("Input variable(s) {0:s} could not be found in "
+                              "the interactive namespace").format(
+                ', '.join(["'{0:s}'".format(_) for _ in inputs_missing])))
+        inputs_md5 = inputs_fingerprint(inputs, ip_user_ns)
+    entry = entry_key(cell_md5, inputs_md5)
 
     if do_save(path, force=force, read=read):
         # Capture the outputs of the cell.
@@ -281,8 +1469,10 @@ def cache(cell, path, vars=[],
         # Save the outputs in the cache.
         cached['_captured_io'] = save_captured_io(io)
         cached['_cell_md5'] = cell_md5
+        if inputs_md5 is not None:
+            cached['_inputs_md5'] = inputs_md5
         # Save the cache in the pickle file.
-        save_vars(path, cached)
+        save_vars(path, cached, entry=entry, max_entries=max_versions)
         # clear away the temporary output and replace with the saved output (ideal?)
         ip_clear_output()
         if verbose:
@@ -294,8 +1484,22 @@ def cache(cell, path, vars=[],
     else:
         # Load the variables from cache in inject them in the namespace.
         force_recalc = False
+        cached = {}
         try:
-            cached = load_vars(path, vars)
+            cached = load_vars(path, vars, columns=columns,
+                               prefetcher=prefetcher, entry=entry)
+        except CacheCorruptedError as e:
+            # Report the damaged variables rather than silently recomputing.
+            sys.stderr.write("[{0:s}.]\n".format(str(e)))
+            cached = e.cache
+            if set(e.damaged) - set(['_captured_io']):
+                if read:
+                    # Still provide the intact variables.
+                    ip_push({var: cached[var] for var in vars
+                             if var in cached})
+                    raise
+                force_recalc = True
+            # Otherwise only the outputs are lost, the variables are loaded.
         except ValueError as e:
             if 'The following variables' in str(e):
                 if read:
@@ -303,11 +1507,14 @@ def cache(cell, path, vars=[],
                 force_recalc = True
             else:
                 raise
-            cached = {}
-        if not '_cell_md5' in cached or cell_md5 != cached['_cell_md5']:
+        if (not '_cell_md5' in cached or cell_md5 != cached['_cell_md5'] or
+                inputs_md5 != cached.get('_inputs_md5')):
             force_recalc = True
         if force_recalc and not read:
-            return cache(cell, path, vars, ip_user_ns, ip_run_cell, ip_push, ip_clear_output, True, read, verbose)
+            return cache(cell, path, vars, ip_user_ns, ip_run_cell, ip_push, ip_clear_output, True, read, verbose, columns,
+                         prefetcher, inputs, max_versions)
+        if not force_recalc and not read and max_versions > 1:
+            use_entry(path, entry)
         # Handle the outputs separately.
         io = load_captured_io(cached.get('_captured_io', {}))
         # Push the remaining variables in the namespace.
@@ -325,13 +1532,40 @@ def cache(cell, path, vars=[],
 class CacheMagics(Magics, Configurable):
     """Variable caching.
 
-    Provides the %cache magic."""
+    Provides the %cache, %cache_prefetch, %cache_export and %cache_import
+    magics."""
 
     cachedir = Unicode('', config=True)
+    # Maximum size in bytes of the cache files held by the prefetch buffer.
+    prefetch_size = Int(1 << 30, config=True)
+    prefetch_threads = Int(4, config=True)
+    # Maximum number of versions of a cell kept in a cache file.
+    max_versions = Int(3, config=True)
 
     def __init__(self, shell=None):
         Magics.__init__(self, shell)
         Configurable.__init__(self, config=shell.config)
+        self.prefetcher = CachePrefetcher(max_size=self.prefetch_size,
+                                          n_threads=self.prefetch_threads)
+
+    def _cache_path(self, to, cachedir=None, safe=False, create=True):
+        """Return the path of a cache file as specified in a %%cache cell."""
+        path = conditional_eval(to, self.shell.user_ns, safe=safe)
+        cachedir_from_path = os.path.split(path)[0]
+        # The cachedir can be specified with --cachedir or inferred from the
+        # path or in ipython_config.py
+        cachedir = cachedir or cachedir_from_path or self.cachedir
+        # If path is relative, use the user-specified cache cachedir.
+        if not os.path.isabs(path) and cachedir:
+            # Try to create the cachedir if it does not already exist.
+            if create and not os.path.exists(cachedir):
+                try:
+                    os.mkdir(cachedir)
+                    print("[Created cachedir '{0:s}'.]".format(cachedir))
+                except:
+                    pass
+            path = os.path.join(cachedir, path)
+        return path
 
     @magic_arguments.magic_arguments()
     @magic_arguments.argument(
@@ -340,7 +1574,8 @@ class CacheMagics(Magics, Configurable):
     )
     @magic_arguments.argument(
         'vars', nargs='*', type=str,
-        help="Variables to save."
+        help=("Variables to save. Use var[col1,col2] to only load some "
+              "columns of a DataFrame or dictionary of arrays.")
     )
     @magic_arguments.argument(
         '-s', '--silent', action='store_true', default=False,
@@ -359,6 +1594,16 @@ class CacheMagics(Magics, Configurable):
         help=("Always read from the file and prevent the cell's execution, "
               "raising an error if the file does not exist.")
     )
+    @magic_arguments.argument(
+        '-i', '--inputs', default='',
+        help=("Comma-separated input variables. A version of the cached "
+              "variables is kept for each value of the inputs.")
+    )
+    @magic_arguments.argument(
+        '-n', '--versions', type=int, default=None,
+        help=("Maximum number of versions of the cell and its inputs kept in "
+              "the file, the least recently used being dropped.")
+    )
     @cell_magic
     def cache(self, line, cell):
         """Cache user variables in a file, and skip the cell if the cached
@@ -373,28 +1618,29 @@ class CacheMagics(Magics, Configurable):
             # injected from the file to the interactive namespace.
             var1 = ...
             var2 = ...
+
+            %%cache myfile.pkl df[col1,col2]
+            # Only the columns col1 and col2 of the DataFrame df are loaded
+            # from the file.
+            df = ...
+
+            %%cache -i param myfile.pkl var
+            # A version of var is kept for each value of param, so that
+            # switching between values of param does not execute the cell.
+            var = f(param)
         """
         ip = self.shell
         args = magic_arguments.parse_argstring(self.cache, line)
         code = cell if cell.endswith('\n') else cell+'\n'
-        vars = clean_vars(args.vars)
-        path = conditional_eval(args.to[0], ip.user_ns)
-        cachedir_from_path = os.path.split(path)[0]
-        # The cachedir can be specified with --cachedir or inferred from the
-        # path or in ipython_config.py
-        cachedir = args.cachedir or cachedir_from_path or self.cachedir
-        # If path is relative, use the user-specified cache cachedir.
-        if not os.path.isabs(path) and cachedir:
-            # Try to create the cachedir if it does not already exist.
-            if not os.path.exists(cachedir):
-                try:
-                    os.mkdir(cachedir)
-                    print("[Created cachedir '{0:s}'.]".format(cachedir))
-                except:
-                    pass
-            path = os.path.join(cachedir, path)
+        vars, columns = split_vars(args.vars, ip.user_ns)
+        vars = clean_vars(vars)
+        inputs = clean_vars(args.inputs.split(',')) if args.inputs else []
+        path = self._cache_path(args.to[0], args.cachedir)
+        versions = self.max_versions if args.versions is None else args.versions
         cache(cell, path, vars=vars,
               force=args.force, verbose=not args.silent, read=args.read,
+              columns=columns, prefetcher=self.prefetcher,
+              inputs=inputs, max_versions=versions,
               # IPython methods
               ip_user_ns=ip.user_ns,
               ip_run_cell=ip.run_cell,
@@ -402,7 +1648,183 @@ class CacheMagics(Magics, Configurable):
               ip_clear_output=clear_output
               )
 
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument(
+        'notebook', nargs='?', type=str,
+        help="Notebook whose %%%%cache cells are prefetched."
+    )
+    @magic_arguments.argument(
+        '-s', '--silent', action='store_true', default=False,
+        help="Do not display information about the prefetched files."
+    )
+    @magic_arguments.argument(
+        '-c', '--clear', action='store_true', default=False,
+        help="Cancel pending loads and release the prefetch buffer."
+    )
+    @line_magic
+    def cache_prefetch(self, line):
+        """Load the cache files of the %%cache cells of a notebook in the
+        background, so that these cells do not wait for the disk.
+
+        Usage:
+
+            %cache_prefetch mynotebook.ipynb
+
+        Paths are resolved with the current namespace. Paths with {code}
+        statements which cannot be evaluated safely, cells run with --force and
+        missing files are skipped.
+        """
+        args = magic_arguments.parse_argstring(self.cache_prefetch, line)
+        if args.clear:
+            self.prefetcher.clear()
+        if not args.notebook:
+            return
+        paths = []
+        user_ns = self.shell.user_ns
+        for cell_line, code in notebook_cache_cells(args.notebook):
+            try:
+                cell_args = magic_arguments.parse_argstring(self.cache,
+                                                            cell_line)
+                if cell_args.force:
+                    continue
+                vars, columns = split_vars(cell_args.vars, user_ns)
+                path = self._cache_path(cell_args.to[0], cell_args.cachedir,
+                                        safe=True, create=False)
+            except Exception:
+                continue
+            # The inputs may not be computed yet, in which case the most
+            # recently used entry is prefetched.
+            inputs = (clean_vars(cell_args.inputs.split(','))
+                      if cell_args.inputs else [])
+            inputs_md5 = None
+            if inputs and all(var in user_ns for var in inputs):
+                try:
+                    inputs_md5 = inputs_fingerprint(inputs, user_ns)
+                except ValueError:
+                    pass
+            entry = (entry_key(hashlib.md5(code.encode()).hexdigest(),
+                               inputs_md5)
+                     if inputs_md5 is not None or not inputs else None)
+            if os.path.exists(path):
+                paths.append((path, columns, entry))
+        self.prefetcher.prefetch(paths)
+        if not args.silent:
+            print("[Prefetching {0:d} cache file(s) from '{1:s}'.]".format(
+                len(paths), args.notebook))
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument(
+        'bundle', type=str,
+        help="Path to the bundle file."
+    )
+    @magic_arguments.argument(
+        'paths', nargs='*', type=str,
+        help="Cache files or directories (the cache directory by default)."
+    )
+    @magic_arguments.argument(
+        '-d', '--cachedir',
+        help="Cache directory relative to which cache files are named."
+    )
+    @line_magic
+    def cache_export(self, line):
+        """Pack cache files into a single bundle file.
+
+        Usage:
+
+            %cache_export caches.ipcb
+            %cache_export caches.ipcb myfile1.pkl myfile2.pkl
+        """
+        args = magic_arguments.parse_argstring(self.cache_export, line)
+        cachedir = args.cachedir or self.cachedir or '.'
+        names = export_bundle(args.bundle, args.paths or [cachedir],
+                              root=cachedir)
+        print("[Exported {0:d} cache file(s) to '{1:s}'.]".format(
+            len(names), args.bundle))
+
+    @magic_arguments.magic_arguments()
+    @magic_arguments.argument(
+        'bundle', type=str,
+        help="Path to the bundle file."
+    )
+    @magic_arguments.argument(
+        'names', nargs='*', type=str,
+        help="Cache files to unpack (all by default)."
+    )
+    @magic_arguments.argument(
+        '-d', '--cachedir',
+        help="Cache directory where the cache files are unpacked."
+    )
+    @line_magic
+    def cache_import(self, line):
+        """Unpack the cache files of a bundle. Existing cache files are not
+        overwritten, only the versions they do not have are added.
+
+        Usage:
+
+            %cache_import caches.ipcb
+        """
+        args = magic_arguments.parse_argstring(self.cache_import, line)
+        cachedir = args.cachedir or self.cachedir or '.'
+        names = import_bundle(args.bundle, root=cachedir,
+                              names=args.names or None,
+                              max_entries=self.max_versions)
+        print("[Imported {0:d} cache file(s) from '{1:s}'.]".format(
+            len(names), args.bundle))
+
+
+def main(argv=None):
+    """Command-line interface to export, import and list cache bundles."""
+    parser = argparse.ArgumentParser(
+        prog='ipycache', description="Manage ipycache cache bundles.")
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser(
+        'export', help="Pack cache files into a bundle.")
+    export_parser.add_argument('bundle', help="Path to the bundle file.")
+    export_parser.add_argument(
+        'paths', nargs='*',
+        help="Cache files or directories (the cache directory by default).")
+    import_parser = subparsers.add_parser(
+        'import', help="Unpack the cache files of a bundle.")
+    import_parser.add_argument('bundle', help="Path to the bundle file.")
+    import_parser.add_argument(
+        'names', nargs='*', help="Cache files to unpack (all by default).")
+    import_parser.add_argument(
+        '-n', '--versions', type=int, default=3,
+        help="Maximum number of versions kept in a cache file when merging.")
+    for subparser in (export_parser, import_parser):
+        subparser.add_argument(
+            '-d', '--cachedir', default='.',
+            help="Cache directory relative to which cache files are named.")
+    list_parser = subparsers.add_parser(
+        'list', help="List the cache files of a bundle.")
+    list_parser.add_argument('bundle', help="Path to the bundle file.")
+    args = parser.parse_args(argv)
+
+    if args.command == 'export':
+        names = export_bundle(args.bundle, args.paths or [args.cachedir],
+                              root=args.cachedir)
+        print("[Exported {0:d} cache file(s) to '{1:s}'.]".format(
+            len(names), args.bundle))
+    elif args.command == 'import':
+        names = import_bundle(args.bundle, root=args.cachedir,
+                              names=args.names or None,
+                              max_entries=args.versions)
+        print("[Imported {0:d} cache file(s) from '{1:s}'.]".format(
+            len(names), args.bundle))
+    elif args.command == 'list':
+        with CacheBundle(args.bundle) as bundle:
+            for name in bundle.names():
+                print(name)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
 
 def load_ipython_extension(ip):
     """Load the extension in IPython."""
     ip.register_magics(CacheMagics)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,6 +23,9 @@ setup(
     keywords="ipython notebook cache",
     url="https://github.com/rossant/ipycache",
     py_modules=['ipycache'],
+    entry_points={
+        'console_scripts': ['ipycache = ipycache:main'],
+    },
     long_description=read('README.md'),
     long_description_content_type='text/markdown',
     classifiers=[
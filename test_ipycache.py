@@ -3,13 +3,41 @@
 """
 
 import hashlib
+import json
 import os
 import pickle
+import shutil
+import struct
+import subprocess
 import sys
 import unittest
-
-from ipycache import (save_vars, load_vars, clean_var, clean_vars, do_save,
-                      cache, exec_, conditional_eval)
+import zlib
+
+from ipycache import (save_vars, load_vars, CacheCorruptedError, clean_var, clean_vars, do_save,
+                      cache, exec_, conditional_eval, split_vars,
+                      notebook_cache_cells, CachePrefetcher, CacheBundle,
+                      export_bundle, import_bundle, main, entry_key,
+                      inputs_fingerprint)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pandas as pd
+    import pyarrow
+except ImportError:
+    pd = None
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+if pd is not None:
+    class MyDataFrame(pd.DataFrame):
+        pass
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] == 3
@@ -42,6 +70,19 @@ class FunctionTests(unittest.TestCase):
         expect = 'abc_10_10'
         self.assertEqual(conditional_eval(test_eval, locals()), expect)
 
+    def test_conditional_eval_safe(self):
+        x, d = 10, {'a': ['b']}
+        self.assertEqual(conditional_eval('abc_{x}_{d["a"][0]}', locals(),
+                                          safe=True), 'abc_10_b')
+        self.assertRaises(ValueError, conditional_eval, 'abc_{x+1}',
+                          locals(), safe=True)
+        self.assertRaises(ValueError, conditional_eval, 'abc_{d}',
+                          locals(), safe=True)
+        self.assertRaises(ValueError, conditional_eval, 'abc_{str(x)}',
+                          locals(), safe=True)
+        self.assertRaises(ValueError, conditional_eval, 'abc_{x.__class__}',
+                          locals(), safe=True)
+
     def test_clean_var(self):
         self.assertEqual(clean_var('abc'), 'abc')
         self.assertEqual(clean_var('abc '), 'abc')
@@ -51,6 +92,14 @@ class FunctionTests(unittest.TestCase):
     def test_clean_vars(self):
         self.assertEqual(clean_vars(['abc', 'abc,']), ['abc'] * 2)
 
+    def test_split_vars(self):
+        self.assertEqual(split_vars(['a', 'b,']), (['a', 'b'], {}))
+        self.assertEqual(split_vars(['df[x,', 'y]', 'b']),
+                         (['df', 'b'], {'df': ['x', 'y']}))
+        cols = ['x', 'y']
+        self.assertEqual(split_vars(['df[$cols,z]'], locals()),
+                         (['df'], {'df': ['x', 'y', 'z']}))
+
     def test_do_save(self):
         path = 'myvars.pkl'
 
@@ -80,6 +129,318 @@ class FunctionTests(unittest.TestCase):
         self.assertEqual(vars, vars2)
         removeFile(path)
 
+    def test_load_pickle(self):
+        path = 'myvars.pkl'
+        vars = {'a': 1, 'b': {'x': 1, 'y': 2}}
+        with open(path, 'wb') as f:
+            pickle.dump(vars, f)
+        self.assertEqual(load_vars(path, ['a', 'b']), vars)
+        self.assertEqual(load_vars(path, ['a', 'b'], columns={'b': ['y']}),
+                         {'a': 1, 'b': {'y': 2}})
+        removeFile(path)
+
+    def test_load_damaged(self):
+        path = 'myvars.pkl'
+        save_vars(path, {'a': 'x' * 100, 'b': 'y' * 100, 'c': 'z' * 100})
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        # A damaged payload only affects its variable.
+        with open(path, 'wb') as f:
+            f.write(data.replace(b'yyyy', b'yyyY', 1))
+        with self.assertRaises(CacheCorruptedError) as cm:
+            load_vars(path, ['a', 'b', 'c'])
+        self.assertEqual(cm.exception.damaged, ['b'])
+        self.assertEqual(cm.exception.cache, {'a': 'x' * 100, 'c': 'z' * 100})
+
+        # Truncated file.
+        with open(path, 'wb') as f:
+            f.write(data[:-10])
+        with self.assertRaises(CacheCorruptedError) as cm:
+            load_vars(path, ['a', 'b', 'c'])
+        self.assertEqual(cm.exception.damaged, ['c'])
+        self.assertEqual(sorted(cm.exception.cache), ['a', 'b'])
+
+        # File truncated between two records.
+        with open(path, 'wb') as f:
+            f.write(data[:data.index(b'zzzz')].rsplit(b'{"crc32"', 1)[0][:-16])
+        with self.assertRaises(CacheCorruptedError) as cm:
+            load_vars(path, ['a', 'b', 'c'])
+        self.assertEqual(cm.exception.damaged, ['c'])
+        removeFile(path)
+
+    @unittest.skipIf(np is None, "numpy is required")
+    def test_load_damaged_columns(self):
+        """Damaged columns are detected when loading some columns."""
+        path = 'myvars.pkl'
+        y = np.full(100, 7, dtype=np.int64)
+        save_vars(path, {'arrays': {'x': np.arange(100), 'y': y}})
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data.replace(y[:2].tobytes(), y[:2].tobytes()[::-1], 1))
+        self.assertRaises(CacheCorruptedError, load_vars, path, ['arrays'],
+                          columns={'arrays': ['y']})
+        vars = load_vars(path, ['arrays'], columns={'arrays': ['x']})
+        np.testing.assert_array_equal(vars['arrays']['x'], np.arange(100))
+        removeFile(path)
+
+    @unittest.skipIf(pd is None, "pandas and pyarrow are required")
+    def test_save_load_dataframe(self):
+        path = 'myvars.pkl'
+        df = pd.DataFrame({'x': [1, 2], 'y': [.5, 1.5], 'z': ['a', 'b']},
+                          index=[10, 20])
+        save_vars(path, {'df': df})
+        pd.testing.assert_frame_equal(load_vars(path, ['df'])['df'], df)
+        df2 = load_vars(path, ['df'], columns={'df': ['z', 'x']})['df']
+        pd.testing.assert_frame_equal(df2, df[['z', 'x']])
+        removeFile(path)
+
+    @unittest.skipIf(pd is None, "pandas and pyarrow are required")
+    def test_save_load_dataframe_pickled(self):
+        """DataFrames which do not round-trip through Arrow are pickled."""
+        path = 'myvars.pkl'
+        lists = pd.DataFrame({'x': [[1, 2], [3]]})
+        save_vars(path, {'lists': lists, 'sub': MyDataFrame({'x': [1]})})
+        vars = load_vars(path, ['lists', 'sub'])
+        self.assertEqual(vars['lists']['x'][0], [1, 2])
+        self.assertIs(type(vars['sub']), MyDataFrame)
+
+        dfs = [
+            pd.DataFrame({'x': pd.Series([1, 2.5], dtype=object)}),
+            pd.DataFrame({'x': pd.Series([1, 2], dtype=object)}),
+            pd.DataFrame({'x': pd.Series(['a', np.nan], dtype=object)}),
+            pd.DataFrame({'x': pd.Series(['a', None], dtype=object)}),
+            pd.DataFrame({'x': [1]}, index=pd.Index([1], name=0)),
+            pd.DataFrame({'x': [1.]}, index=pd.Index(['a'], dtype=object)),
+            pd.DataFrame({'x': ['a', None], 'y': pd.Categorical(['a', 'b']),
+                          'z': pd.to_datetime(['2020-01-01', None])},
+                         index=pd.Index([3, 4], name='i')),
+        ]
+        for df in dfs:
+            save_vars(path, {'df': df})
+            pd.testing.assert_frame_equal(load_vars(path, ['df'])['df'], df)
+        removeFile(path)
+
+    @unittest.skipIf(np is None or cloudpickle is None,
+                     "numpy and cloudpickle are required")
+    def test_save_load_large_array(self):
+        """cloudpickle writes large arrays as out-of-band buffers."""
+        path = 'myvars.pkl'
+        a = np.ones(200000)
+        save_vars(path, {'a': a})
+        np.testing.assert_array_equal(load_vars(path, ['a'])['a'], a)
+        removeFile(path)
+
+    @unittest.skipIf(np is None, "numpy is required")
+    def test_save_load_arrays(self):
+        path = 'myvars.pkl'
+        arrays = {'x': np.arange(10), 'y': np.ones((2, 3))}
+        save_vars(path, {'arrays': arrays, 'a': 1})
+        vars = load_vars(path, ['arrays', 'a'])
+        self.assertEqual(vars['a'], 1)
+        self.assertEqual(sorted(vars['arrays']), ['x', 'y'])
+        np.testing.assert_array_equal(vars['arrays']['y'], arrays['y'])
+        vars = load_vars(path, ['arrays', 'a'], columns={'arrays': ['x']})
+        self.assertEqual(list(vars['arrays']), ['x'])
+        np.testing.assert_array_equal(vars['arrays']['x'], arrays['x'])
+        # Subclasses of arrays are pickled.
+        masked = {'x': np.ma.masked_array([1, 2], mask=[0, 1])}
+        save_vars(path, {'masked': masked})
+        vars = load_vars(path, ['masked'])
+        self.assertTrue(vars['masked']['x'].mask[1])
+        removeFile(path)
+
+
+class PrefetchTests(unittest.TestCase):
+
+    def test_notebook_cache_cells(self):
+        path = 'mynotebook.ipynb'
+        nb = {'cells': [
+            {'cell_type': 'markdown', 'source': '%%cache no.pkl a'},
+            {'cell_type': 'code', 'source': ['%%cache a.pkl a\n', 'a = 1']},
+            {'cell_type': 'code', 'source': 'b = 1'},
+            {'cell_type': 'code', 'source': '%%cache -s $p b\nb = 2'},
+        ]}
+        with open(path, 'w') as f:
+            json.dump(nb, f)
+        self.assertEqual(notebook_cache_cells(path),
+                         [('a.pkl a', 'a = 1\n'), ('-s $p b', 'b = 2\n')])
+        removeFile(path)
+
+    def test_prefetch(self):
+        paths = ['myvars1.pkl', 'myvars2.pkl']
+        for i, path in enumerate(paths):
+            save_vars(path, {'a': i})
+        prefetcher = CachePrefetcher()
+        prefetcher.prefetch([(path, {}, None) for path in paths])
+        prefetcher.join()
+        self.assertEqual(prefetcher.take(paths[0]), ({'a': 0}, []))
+        # The variables are only returned once.
+        self.assertEqual(prefetcher.take(paths[0]), None)
+        self.assertEqual(load_vars(paths[1], ['a'], prefetcher=prefetcher),
+                         {'a': 1})
+        # Modified files are ignored.
+        prefetcher.prefetch([(paths[0], {}, None)])
+        prefetcher.join()
+        save_vars(paths[0], {'a': 2, 'b': 3})
+        os.utime(paths[0], (0, 0))
+        self.assertEqual(prefetcher.take(paths[0]), None)
+        for path in paths:
+            removeFile(path)
+
+    def test_prefetch_magic(self):
+        """The entries prefetched from a notebook are those of its cells."""
+        from IPython.testing.globalipapp import get_ipython
+        ip = get_ipython()
+        ip.extension_manager.load_extension('ipycache')
+        magics = ip.magics_manager.registry['CacheMagics']
+        path, nb_path = 'myvars.pkl', 'mynotebook.ipynb'
+        # The notebook source has no trailing newline.
+        source = '%%cache -s myvars.pkl a\na = 1'
+        with open(nb_path, 'w') as f:
+            json.dump({'cells': [{'cell_type': 'code', 'source': source}]}, f)
+        ip.run_cell(source)
+        ip.run_line_magic('cache_prefetch', '-s ' + nb_path)
+        magics.prefetcher.join()
+        entry = entry_key(hashlib.md5(b'a = 1\n').hexdigest())
+        cache, damaged = magics.prefetcher.take(path, {}, entry)
+        self.assertEqual(cache['a'], 1)
+        self.assertEqual(damaged, [])
+        removeFile(path)
+        removeFile(nb_path)
+
+    def test_prefetch_max_size(self):
+        path = 'myvars.pkl'
+        save_vars(path, {'a': 1})
+        prefetcher = CachePrefetcher(max_size=1)
+        prefetcher.prefetch([(path, {}, None)])
+        prefetcher.join()
+        self.assertEqual(prefetcher.take(path), None)
+        removeFile(path)
+
+    def test_prefetch_wait_for_space(self):
+        paths = ['myvars1.pkl', 'myvars2.pkl']
+        for i, path in enumerate(paths):
+            save_vars(path, {'a': i})
+        prefetcher = CachePrefetcher(max_size=os.path.getsize(paths[0]))
+        prefetcher.prefetch([(path, {}, None) for path in paths])
+        prefetcher.join()
+        # The second file is loaded once the first one is taken.
+        self.assertEqual(prefetcher.take(paths[0]), ({'a': 0}, []))
+        prefetcher.join()
+        self.assertEqual(prefetcher.take(paths[1]), ({'a': 1}, []))
+        # A file waiting for space is loaded when it is needed.
+        prefetcher.prefetch([(path, {}, None) for path in paths])
+        prefetcher.join()
+        self.assertEqual(prefetcher.take(paths[1]), ({'a': 1}, []))
+        self.assertEqual(prefetcher.take(paths[0]), ({'a': 0}, []))
+        for path in paths:
+            removeFile(path)
+
+
+class BundleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = 'mycachedir'
+        self.bundle = 'mycaches.ipcb'
+        os.makedirs(os.path.join(self.cachedir, 'sub'))
+        save_vars(os.path.join(self.cachedir, 'a.pkl'), {'a': 1})
+        save_vars(os.path.join(self.cachedir, 'sub', 'b.pkl'), {'b': 2})
+        with open(os.path.join(self.cachedir, 'c.pkl'), 'wb') as f:
+            pickle.dump({'c': 3}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+        removeFile(self.bundle)
+
+    def test_bundle(self):
+        names = export_bundle(self.bundle, [self.cachedir],
+                              root=self.cachedir)
+        self.assertEqual(names, ['a.pkl', 'c.pkl', 'sub/b.pkl'])
+        with CacheBundle(self.bundle) as bundle:
+            self.assertEqual(bundle.names(), names)
+            self.assertIn('sub/b.pkl', bundle)
+            self.assertEqual(bundle.load_vars('sub/b.pkl', ['b']), {'b': 2})
+            self.assertEqual(bundle.load_vars('c.pkl', ['c']), {'c': 3})
+            self.assertRaises(KeyError, bundle.load_vars, 'd.pkl', ['d'])
+
+        # Only the missing files are imported.
+        os.remove(os.path.join(self.cachedir, 'sub', 'b.pkl'))
+        save_vars(os.path.join(self.cachedir, 'a.pkl'), {'a': 4})
+        self.assertEqual(import_bundle(self.bundle, root=self.cachedir),
+                         ['sub/b.pkl'])
+        self.assertEqual(
+            load_vars(os.path.join(self.cachedir, 'sub', 'b.pkl'), ['b']),
+            {'b': 2})
+
+    def test_bundle_merge(self):
+        """The entries missing from existing files are imported."""
+        path = os.path.join(self.cachedir, 'a.pkl')
+        save_vars(path, {'a': 1}, entry='x', max_entries=2)
+        export_bundle(self.bundle, [path], root=self.cachedir)
+        save_vars(path, {'a': 2}, entry='y', max_entries=1)
+        self.assertEqual(import_bundle(self.bundle, root=self.cachedir),
+                         ['a.pkl'])
+        self.assertEqual(load_vars(path, ['a'], entry='y'), {'a': 2})
+        self.assertEqual(load_vars(path, ['a'], entry='x'), {'a': 1})
+        # Nothing left to import.
+        self.assertEqual(import_bundle(self.bundle, root=self.cachedir), [])
+
+    def test_bundle_skipped_files(self):
+        """Files which are not cache files, such as the bundle itself, are not
+        bundled."""
+        bundle = os.path.join(self.cachedir, 'caches.ipcb')
+        with open(os.path.join(self.cachedir, 'notes.txt'), 'w') as f:
+            f.write('(notes)\n')
+        with open(os.path.join(self.cachedir, 'nb.ipynb'), 'w') as f:
+            json.dump({'cells': []}, f)
+        for _ in range(2):
+            names = export_bundle(bundle, [self.cachedir], root=self.cachedir)
+            self.assertEqual(names, ['a.pkl', 'c.pkl', 'sub/b.pkl'])
+        # Cache files outside of the cache directory cannot be named.
+        self.assertRaises(ValueError, export_bundle, self.bundle,
+                          [os.path.join(self.cachedir, 'a.pkl')],
+                          root=os.path.join(self.cachedir, 'sub'))
+
+    def test_bundle_invalid_names(self):
+        """Cache files cannot be imported outside of the cache directory."""
+        export_bundle(self.bundle, [self.cachedir], root=self.cachedir)
+        with open(self.bundle, 'rb') as f:
+            data = f.read()
+        for old, new in ((b'"sub/b.pkl"', b'"../bb.pkl"'),
+                         (b'"c.pkl"', b'"/c.pk"')):
+            with open(self.bundle, 'wb') as f:
+                f.write(data.replace(old, new))
+            self.assertRaises(ValueError, import_bundle, self.bundle,
+                              root=os.path.join(self.cachedir, 'sub'))
+        self.assertFalse(os.path.exists('bb.pkl'))
+        self.assertFalse(os.path.exists('/c.pk'))
+
+    def test_bundle_merge_max_entries(self):
+        """Merged files keep at most max_entries entries."""
+        path = os.path.join(self.cachedir, 'a.pkl')
+        save_vars(path, {'a': 1}, entry='x', max_entries=3)
+        save_vars(path, {'a': 2}, entry='y', max_entries=3)
+        export_bundle(self.bundle, [path], root=self.cachedir)
+        save_vars(path, {'a': 3}, entry='z', max_entries=1)
+        import_bundle(self.bundle, root=self.cachedir, max_entries=2)
+        self.assertEqual(load_vars(path, ['a'], entry='z'), {'a': 3})
+        # The most recently used entry of the bundled file is added.
+        self.assertEqual(load_vars(path, ['a'], entry='y'), {'a': 2})
+        self.assertEqual(load_vars(path, ['a'], entry='x'), {'a': 3})
+
+    def test_main(self):
+        old_stdout = sys.stdout
+        sys.stdout = mystdout = StringIO()
+        main(['export', self.bundle, '-d', self.cachedir])
+        main(['list', self.bundle])
+        shutil.rmtree(self.cachedir)
+        main(['import', self.bundle, 'a.pkl', '-d', self.cachedir])
+        sys.stdout = old_stdout
+        self.assertIn('a.pkl\nc.pkl\nsub/b.pkl\n', mystdout.getvalue())
+        self.assertEqual(os.listdir(self.cachedir), ['a.pkl'])
+
 
 class CacheMagicTests(unittest.TestCase):
     def test_cache_1(self):
@@ -117,8 +478,7 @@ class CacheMagicTests(unittest.TestCase):
         cache("""a = 1""", path, vars=['a'], force=False, read=False,
               ip_user_ns=user_ns, ip_run_cell=ip_run_cell, ip_push=ip_push)
         # hack the md5 so code change does not retrigger
-        with open(path, 'rb') as op:
-            data = pickle.load(op)
+        data = load_vars(path, ['a'])
         data['_cell_md5'] = hashlib.md5("""a = 2""".encode()).hexdigest()
         with open(path, 'wb') as op:
             pickle.dump(data, op)
@@ -197,6 +557,174 @@ class CacheMagicTests(unittest.TestCase):
 
         removeFile(path)
 
+    def test_cache_damaged(self):
+        """A damaged cache file is reported and the cell is executed again."""
+        path = 'myvars.pkl'
+        cell = """a = 'x' * 100"""
+
+        user_ns = {}
+
+        def ip_run_cell(cell):
+            exec_(cell, {}, user_ns)
+
+        def ip_push(vars):
+            user_ns.update(vars)
+
+        cache(cell, path, vars=['a'], verbose=False,
+              ip_user_ns=user_ns, ip_run_cell=ip_run_cell, ip_push=ip_push)
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'wb') as f:
+            f.write(data.replace(b'xxxx', b'xxxX', 1))
+
+        old_stderr = sys.stderr
+        sys.stderr = mystderr = StringIO()
+        user_ns = {}
+        cache(cell, path, vars=['a'], verbose=False,
+              ip_user_ns=user_ns, ip_run_cell=ip_run_cell, ip_push=ip_push)
+        sys.stderr = old_stderr
+
+        self.assertEqual(user_ns['a'], 'x' * 100)
+        self.assertIn("'a'", mystderr.getvalue())
+        # The cache file has been written again.
+        self.assertEqual(load_vars(path, ['a'])['a'], 'x' * 100)
+        removeFile(path)
+
+    def test_cache_versions(self):
+        """Several versions of a cell are kept, the least recently used one
+        being dropped."""
+        path = 'myvars.pkl'
+        user_ns = {}
+        runs = []
+
+        def ip_run_cell(cell):
+            runs.append(cell)
+            exec_(cell, {}, user_ns)
+
+        def ip_push(vars):
+            user_ns.update(vars)
+
+        def run(cell):
+            del runs[:]
+            cache(cell, path, vars=['a'], verbose=False, max_versions=2,
+                  ip_user_ns=user_ns, ip_run_cell=ip_run_cell, ip_push=ip_push)
+            return bool(runs)
+
+        self.assertTrue(run("a = 1"))
+        self.assertTrue(run("a = 2"))
+        # Switching between the two versions does not execute the cell, nor
+        # rewrite the cache file.
+        ino = os.stat(path).st_ino
+        self.assertFalse(run("a = 1"))
+        self.assertEqual(user_ns['a'], 1)
+        self.assertEqual(os.stat(path).st_ino, ino)
+        # The file is not modified in --read mode.
+        with open(path, 'rb') as f:
+            data = f.read()
+        cache("a = 2", path, vars=['a'], verbose=False, max_versions=2,
+              read=True, ip_user_ns=user_ns, ip_run_cell=ip_run_cell,
+              ip_push=ip_push)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertFalse(run("a = 2"))
+        self.assertEqual(user_ns['a'], 2)
+        self.assertFalse(run("a = 1"))
+        # "a = 2" is the least recently used version.
+        self.assertTrue(run("a = 3"))
+        self.assertFalse(run("a = 1"))
+        self.assertTrue(run("a = 2"))
+        removeFile(path)
+
+    def test_cache_legacy_versions(self):
+        """The entry of a file written before version 3 is kept."""
+        path = 'myvars.pkl'
+        user_ns = {}
+        runs = []
+
+        def ip_run_cell(cell):
+            runs.append(cell)
+            exec_(cell, {}, user_ns)
+
+        def ip_push(vars):
+            user_ns.update(vars)
+
+        def run(cell):
+            del runs[:]
+            cache(cell, path, vars=['a'], verbose=False, max_versions=2,
+                  ip_user_ns=user_ns, ip_run_cell=ip_run_cell, ip_push=ip_push)
+            return bool(runs)
+
+        # Version 2 file.
+        vars = {'a': 1, '_cell_md5': hashlib.md5(b"a = 1").hexdigest()}
+        with open(path, 'wb') as f:
+            f.write(b'IPYCACHE' + struct.pack('<HI', 2, len(vars)))
+            for name in sorted(vars):
+                payload = pickle.dumps(vars[name], 2)
+                meta = json.dumps({'name': name, 'format': 'pickle',
+                                   'crc32': '{0:08x}'.format(
+                                       zlib.crc32(payload) & 0xffffffff)})
+                meta = meta.encode('utf-8')
+                f.write(struct.pack('<IQI', len(meta), len(payload),
+                                    zlib.crc32(meta) & 0xffffffff))
+                f.write(meta + payload)
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertFalse(run("a = 1"))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        self.assertTrue(run("a = 2"))
+        self.assertFalse(run("a = 1"))
+        self.assertEqual(user_ns['a'], 1)
+        self.assertFalse(run("a = 2"))
+        removeFile(path)
+
+    def test_inputs_fingerprint(self):
+        """The fingerprint of sets does not depend on the hash seed."""
+        code = ("from ipycache import inputs_fingerprint; "
+                "print(inputs_fingerprint(['s'], "
+                "{'s': [set('abcdefgh'), {'x': frozenset('ijkl')}]}))")
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output([sys.executable, '-c', code],
+                                                env=env))
+        self.assertEqual(len(outputs), 1)
+        with self.assertRaises(ValueError) as cm:
+            inputs_fingerprint(['f'], {'f': lambda x: x})
+        self.assertIn("'f'", str(cm.exception))
+
+    def test_cache_inputs(self):
+        """A version is kept for each value of the inputs."""
+        path = 'myvars.pkl'
+        cell = """b = a * 2"""
+        user_ns = {}
+        runs = []
+
+        def ip_run_cell(cell):
+            runs.append(cell)
+            exec_(cell, {}, user_ns)
+
+        def ip_push(vars):
+            user_ns.update(vars)
+
+        def run(a):
+            del runs[:]
+            user_ns['a'] = a
+            cache(cell, path, vars=['b'], verbose=False, inputs=['a'],
+                  max_versions=3, ip_user_ns=user_ns, ip_run_cell=ip_run_cell,
+                  ip_push=ip_push)
+            self.assertEqual(user_ns['b'], a * 2)
+            return bool(runs)
+
+        self.assertTrue(run(1))
+        self.assertTrue(run(2))
+        self.assertFalse(run(1))
+        self.assertFalse(run(2))
+        self.assertRaises(ValueError, cache, cell, path, vars=['b'],
+                          inputs=['c'], ip_user_ns=user_ns,
+                          ip_run_cell=ip_run_cell, ip_push=ip_push)
+        removeFile(path)
+
     def test_cache_fail_1(self):
         """Fails when saving nonexistent variables."""
         path = 'myvars.pkl'